@@ -1,71 +1,72 @@
 
 #!/usr/bin/env python
 
+import asyncio
+import functools
+import hashlib
+import inspect
 import json
+import math
 import os
-import time
-import requests
+import random
+import httpx
+import orjson
 from decouple import config
+from diskcache import Cache
 import datetime
 import re
-
-from llama_index.core.llms import ChatMessage, MessageRole
-from llama_index.core import Settings
-from llama_index.llms.anthropic import Anthropic
-from llama_index.llms.openai import OpenAI
+from email.utils import parsedate_to_datetime
+from statistics import median
 
 # Note: To understand this code, it may be easiest to start with the `main()`
 # function and read the code that is called from there.
 
-CHECKPOINT_FILE = "processed_questions.json"
-MAX_RETRIES = 3
-BACKOFF_FACTOR = 2
+# API keys, read once from the environment or the ".env" file
+METAC_TOKEN = config("METACULUS_TOKEN")
+PERPLEXITY_API_KEY = config("PERPLEXITY_API_KEY", default="-")
 
-def load_processed_questions():
-    """Load the list of processed question IDs from a JSON file."""
-    if os.path.exists(CHECKPOINT_FILE):
-        with open(CHECKPOINT_FILE, "r") as file:
-            return json.load(file)
-    return []
-
-def save_processed_question(question_id):
-    """Save a processed question ID to the JSON file."""
-    processed_questions = load_processed_questions()
-    if question_id not in processed_questions:
-        processed_questions.append(question_id)
-        with open(CHECKPOINT_FILE, "w") as file:
-            json.dump(processed_questions, file)
-
-def retry_request(func, *args, **kwargs):
-    """Retry mechanism to retry API requests on failure."""
-    for attempt in range(1, MAX_RETRIES + 1):
-        try:
-            response = func(*args, **kwargs)
-            response.raise_for_status()
-            return response
-        except requests.exceptions.RequestException as e:
-            print(f"Attempt {attempt} failed: {e}")
-            if attempt < MAX_RETRIES:
-                wait_time = BACKOFF_FACTOR ** (attempt - 1)
-                print(f"Retrying in {wait_time} seconds...")
-                time.sleep(wait_time)
-            else:
-                print("Max retries reached. Skipping this request.")
-                return None
-
-def build_prompt(
-        title: str,
-        description: str,
-        resolution_criteria: str,
-        fine_print: str,
-        news_info: str | None = None
-    ):
-    """
-    Function to build the prompt using various arguments.
-    """
-
-    prompt = f"""
+# Number of forecasts sampled per question. A single forecast is made
+# deterministically (temperature 0), several ones are sampled at temperature
+# SAMPLING_TEMPERATURE and their median is used.
+N_SAMPLES = config("N_SAMPLES", default=1, cast=int)
+if N_SAMPLES < 1:
+    raise ValueError(f"N_SAMPLES must be at least 1, got {N_SAMPLES}.")
+SAMPLING_TEMPERATURE = 0.7
 
+CHECKPOINT_FILE = "processed_questions.json"
+MAX_RETRIES = 6
+BACKOFF_BASE = 0.5 # seconds, upper bound of the first wait, doubled on every retry
+BACKOFF_CAP = 30 # seconds, the wait between two attempts never exceeds this
+MAX_RETRY_AFTER = 120 # seconds, longest Retry-After from a server we are willing to wait
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+RETRY_EXCEPTIONS = (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError)
+MAX_CONCURRENT_QUESTIONS = 8 # number of questions forecasted at the same time
+REQUEST_TIMEOUT = 120 # seconds, LLM calls can take a while to complete
+CACHE_DIR = ".llm_cache"
+CACHE_EXPIRE = 24 * 60 * 60 # seconds, cached LLM responses older than a day are not reused
+NEWS_DESCRIPTION_CHARS = 500 # length of the question description passed on to Perplexity
+NEWS_MIN_TIME_LEFT = datetime.timedelta(hours=6) # questions closing sooner are forecasted without news
+PROBABILITY_PATTERN = re.compile(r"Probability:\s*(\d{1,3}(?:\.\d+)?)\s*%", re.IGNORECASE)
+PERCENTAGE_PATTERN = re.compile(r"(?<![\d.])(\d{1,3}(?:\.\d+)?)%")
+
+# A single client shared by all requests, so that connections (and their TLS
+# handshakes) are reused and many requests can be in flight at the same time.
+# HTTP/2 lets concurrent requests to the same host share one connection.
+CLIENT = httpx.AsyncClient(
+    http2=True,
+    follow_redirects=True, # like requests, which the bot used before
+    timeout=REQUEST_TIMEOUT,
+    limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+)
+
+# Responses of the LLM calls, stored on disk so that re-running the bot (e.g.
+# after a crash or during development) does not pay for the same calls again.
+CACHE = Cache(CACHE_DIR)
+
+# The analyst persona is identical for every question. It is sent as the system
+# message, so the shared prefix of all forecasting requests can be cached by
+# the provider.
+SYSTEM_PROMPT = """
 You are an intelligence analyst at an important government agency tasked with
 assessing open-source intelligence and reasoning about similar previous
 situations to develop a probabilistic estimate for a question asked by your
@@ -95,7 +96,135 @@ You can't know the future, and your superior knows that, so it is more important
  hedge your uncertainty, but try to give the most likely point estimate for the
  event in question happening. Remember to make sure that your point estimate
  accurately reflects your research and analysis.
-    
+"""
+
+def load_processed_questions():
+    """Load the set of processed question IDs from a JSON file."""
+    if os.path.exists(CHECKPOINT_FILE):
+        with open(CHECKPOINT_FILE, "r") as file:
+            return set(json.load(file))
+    return set()
+
+def save_processed_question(question_id, processed_questions):
+    """
+    Add a processed question ID to the in-memory set and write the set to the
+    JSON file. The file is replaced atomically, so an interrupted run never
+    leaves a half-written checkpoint behind. This does not await anything, so
+    concurrently running questions cannot interleave their writes.
+    """
+    if question_id in processed_questions:
+        return
+    processed_questions.add(question_id)
+    tmp_file = CHECKPOINT_FILE + ".tmp"
+    with open(tmp_file, "w") as file:
+        json.dump(sorted(processed_questions), file)
+    os.replace(tmp_file, CHECKPOINT_FILE)
+
+def get_completion_content(response: httpx.Response) -> str:
+    """
+    Parse a chat completions response once and return the content of its first
+    choice.
+    """
+    return get_completion_contents(response)[0]
+
+def get_completion_contents(response: httpx.Response) -> list[str]:
+    """
+    Parse a chat completions response once and return the contents of all its
+    choices.
+    """
+    data = orjson.loads(response.content)
+    choices = data.get("choices")
+    if not choices:
+        raise ValueError(f"The response contains no choices: {data}")
+    return [choice["message"]["content"] for choice in choices]
+
+def cached(*key_params, expire=CACHE_EXPIRE):
+    """
+    Decorator caching the result of an async function in CACHE. The cache key
+    is a SHA-256 hash of the function name and the arguments named in
+    `key_params`, so arguments like API tokens don't affect it. None results
+    (failed calls) are not cached.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key_data = json.dumps([func.__name__] + [bound.arguments[p] for p in key_params])
+            key = hashlib.sha256(key_data.encode()).hexdigest()
+            result = CACHE.get(key)
+            if result is not None:
+                return result
+            result = await func(*args, **kwargs)
+            if result is not None:
+                CACHE.set(key, result, expire=expire)
+            return result
+        return wrapper
+    return decorator
+
+def get_retry_wait_time(error: httpx.HTTPError, attempt: int) -> float:
+    """
+    Number of seconds to wait before retrying a failed request. A Retry-After
+    header sent with a 429 or 503 response is honoured, otherwise a truncated
+    exponential backoff with full jitter is used.
+    """
+    if isinstance(error, httpx.HTTPStatusError) and error.response.status_code in (429, 503):
+        retry_after = error.response.headers.get("Retry-After")
+        if retry_after:
+            try:
+                wait_time = float(retry_after)
+            except ValueError:
+                # Retry-After can also be given as an HTTP date
+                try:
+                    retry_at = parsedate_to_datetime(retry_after)
+                    wait_time = (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+                except (TypeError, ValueError):
+                    wait_time = None
+            if wait_time is not None:
+                return min(MAX_RETRY_AFTER, max(0.0, wait_time))
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** (attempt - 1)))
+
+async def retry_request(func, *args, log=print, **kwargs):
+    """
+    Retry mechanism to retry API requests on transient failures (timeouts,
+    connection errors and 429/5xx responses). Other errors, and the last error
+    once all retries are used up, are raised to the caller. Messages about
+    failed attempts are passed to `log`.
+    """
+    for attempt in range(1, MAX_RETRIES + 1):
+        try:
+            response = await func(*args, **kwargs)
+            response.raise_for_status()
+            return response
+        except httpx.HTTPError as e:
+            log(f"Attempt {attempt} failed: {e}")
+            if isinstance(e, httpx.HTTPStatusError):
+                retryable = e.response.status_code in RETRY_STATUS_CODES
+            else:
+                retryable = isinstance(e, RETRY_EXCEPTIONS)
+            if not retryable or attempt == MAX_RETRIES:
+                log("Not retrying this request.")
+                raise
+            wait_time = get_retry_wait_time(e, attempt)
+            log(f"Retrying in {wait_time:.1f} seconds...")
+            await asyncio.sleep(wait_time)
+
+def build_prompt(
+        title: str,
+        description: str,
+        resolution_criteria: str,
+        fine_print: str,
+        today: str,
+        news_info: str | None = None
+    ):
+    """
+    Function to build the prompt using various arguments. Returns the system
+    message, which is the same for every question, and the user message.
+    """
+
+    prompt = f"""
 Your interview question is:
 {title}
 
@@ -117,7 +246,7 @@ Your research assistant says:
 
 
     prompt += f"""
-Today is {datetime.datetime.now().strftime("%Y-%m-%d")}.
+Today is {today}.
 
 Before answering you write:
 (a) The time left until the outcome to the question is known.
@@ -125,26 +254,65 @@ Before answering you write:
 (c) What you would forecast if there was only a quarter of the time left.
 (d) What you would forecast if there was 4x the time left.
 
-You write your rationale and then the last thing you write is your final answer as: "Probability: ZZ%", 0-100
+You answer with a JSON object with two keys: "rationale", a string containing
+your full reasoning including (a) to (d), and "probability", your final answer
+as a number between 0 and 1.
 """
 
-    return prompt
+    return SYSTEM_PROMPT, prompt
+
+def process_forecast(forecast_text: str):
+    """
+    Extract the forecast probability and the rationale from the JSON the model
+    is asked to answer with. The probability is returned as a percentage,
+    clamped between 1 and 99, or None if the JSON contains no valid one.
+    Only if the answer is not JSON at all, the probability is taken from the
+    text instead and the whole text is used as the rationale.
+    """
+    try:
+        forecast = json.loads(forecast_text)
+    except ValueError:
+        return process_forecast_probability(forecast_text), forecast_text
+
+    if not isinstance(forecast, dict):
+        return None, forecast_text
+    rationale = str(forecast.get("rationale", ""))
+    probability = forecast.get("probability")
+    # bools are ints to Python, and json.loads accepts NaN and Infinity
+    if (
+        isinstance(probability, bool)
+        or not isinstance(probability, (int, float))
+        or not math.isfinite(probability)
+    ):
+        return None, rationale
+
+    # Some answers give the probability as a percentage despite the instructions
+    number = round(probability if probability > 1 else probability * 100)
+    number = min(99, max(1, number)) # clamp the number between 1 and 99
+    return number, rationale
 
 def process_forecast_probability(forecast_text: str):
     """
     Extract the forecast probability from the forecast text and clamp it between 1 and 99.
+    A "Probability: ZZ%" line is preferred, otherwise the last percentage in
+    the text is used.
     """
-    matches = re.findall(r"(\d+)%", forecast_text)
-    if matches:
+    match = None
+    for match in PROBABILITY_PATTERN.finditer(forecast_text):
+        pass
+    if match is None:
+        for match in PERCENTAGE_PATTERN.finditer(forecast_text):
+            pass
+    if match is not None:
         # Return the last number found before a '%'
-        number = int(matches[-1])
+        number = round(float(match.group(1)))
         number = min(99, max(1, number)) # clamp the number between 1 and 99
         return number
     else:
         return None
 
 
-def list_questions(base_url: str, metac_token: str, tournament_id: int, offset=0, count=30):
+async def list_questions(base_url: str, metac_token: str, tournament_id: int, offset=0, count=30):
     """
     List questions from a specific tournament. This uses the questions
     endpoint and queries it for questions belonging to a specific tournament.
@@ -183,7 +351,8 @@ def list_questions(base_url: str, metac_token: str, tournament_id: int, offset=0
         "include_description": "true", # include the description in the results
     }
     url = f"{base_url}/questions/" # url for the questions endpoint
-    response = requests.get(
+    response = await retry_request(
+        CLIENT.get,
         url,
         headers={"Authorization": f"Token {metac_token}"},
         params=url_qparams
@@ -194,11 +363,47 @@ def list_questions(base_url: str, metac_token: str, tournament_id: int, offset=0
     # base_url/questions/, then a "?"" before the first url param and then a "&"
     # between additional parameters
 
-    response.raise_for_status()
-    data = json.loads(response.content)
+    data = orjson.loads(response.content)
     return data["results"]
 
-def call_metaculus_proxy(prompt: str, metac_token: str):
+async def iter_questions(base_url: str, metac_token: str, tournament_id: int, count=30):
+    """
+    Iterate over all questions of a tournament, fetching them page by page
+    with `list_questions`, so forecasting can start right after the first page
+    arrives.
+
+    Yields:
+    -------
+    json
+        A JSON object containing information for a single question
+    """
+    offset = 0
+    while True:
+        questions = await list_questions(base_url, metac_token, tournament_id, offset=offset, count=count)
+
+        # Debugging: Check how many questions are fetched and current offset
+        print(f"Fetched {len(questions)} questions with offset {offset}")
+
+        for question in questions:
+            yield question
+
+        if len(questions) < count:
+            print("No more questions to fetch.")
+            return
+
+        # Update the offset to fetch the next batch of questions
+        offset += len(questions)
+
+@cached("prompt", "system_prompt", "n", "temperature", "json_output")
+async def acall_metaculus_proxy(
+        prompt: str,
+        metac_token: str,
+        system_prompt: str = "You are a helpful assistant.",
+        n: int = 1,
+        temperature: float | None = None,
+        json_output: bool = False,
+        log=print
+    ):
     """
     Call the Metaculus proxy API to generate a completion using GPT-4o model.
     
@@ -208,11 +413,23 @@ def call_metaculus_proxy(prompt: str, metac_token: str):
         The prompt to send to the proxy API.
     metac_token : str
         The Metaculus token to authenticate with the proxy.
+    system_prompt : str, optional
+        The system message sent ahead of the prompt.
+    n : int, optional
+        The number of completions to sample for the prompt. They are requested
+        in a single call, sharing the processing of the prompt.
+    temperature : float, optional
+        The sampling temperature. The API default is used if not given.
+    json_output : bool, optional
+        Whether the model is forced to answer with a JSON object. The prompt
+        has to ask for JSON as well.
+    log : Callable, optional
+        Where messages about retried requests go.
 
     Returns:
     --------
-    str
-        The response content from the assistant.
+    list[str]
+        The response contents from the assistant, one per completion.
     """
     url = "https://www.metaculus.com/proxy/openai/v1/chat/completions/"
     headers = {
@@ -223,17 +440,60 @@ def call_metaculus_proxy(prompt: str, metac_token: str):
     payload = {
         "model": "gpt-4o",
         "messages": [
-            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "system", "content": system_prompt},
             {"role": "user", "content": prompt}
-        ]
+        ],
+        "n": n,
     }
-
-    response = requests.post(url=url, json=payload, headers=headers)
-    response.raise_for_status()  # Throw an error if the request fails
-    content = response.json()["choices"][0]["message"]["content"]
-    return content
-
-def call_perplexity(query):
+    if temperature is not None:
+        payload["temperature"] = temperature
+    if json_output:
+        payload["response_format"] = {"type": "json_object"}
+
+    response = await retry_request(CLIENT.post, url=url, content=orjson.dumps(payload), headers=headers, log=log)
+    contents = get_completion_contents(response)
+
+    # Should the proxy not forward `n`, the missing completions are requested
+    # separately
+    if len(contents) < n:
+        payload["n"] = 1
+        responses = await asyncio.gather(*(
+            retry_request(CLIENT.post, url=url, content=orjson.dumps(payload), headers=headers, log=log)
+            for _ in range(n - len(contents))
+        ))
+        contents += [get_completion_content(response) for response in responses]
+    return contents
+
+def should_fetch_news(question) -> bool:
+    """
+    Whether asking Perplexity about a question is worth it. It isn't for
+    questions that close within NEWS_MIN_TIME_LEFT: the forecast only stands
+    for a short while, so it is made without the slow, rate-limited call.
+    """
+    close_time = question["question"].get("scheduled_close_time") or question.get("scheduled_close_time")
+    if not close_time:
+        return True
+    try:
+        close_time = datetime.datetime.fromisoformat(close_time)
+    except ValueError:
+        return True
+    if close_time.tzinfo is None:
+        close_time = close_time.replace(tzinfo=datetime.timezone.utc)
+    return close_time - datetime.datetime.now(datetime.timezone.utc) > NEWS_MIN_TIME_LEFT
+
+def build_news_query(question) -> str:
+    """
+    Build the query for Perplexity: the question title followed by the start
+    of its description, capped at NEWS_DESCRIPTION_CHARS characters.
+    """
+    query = question["question"]["title"]
+    description = (question["question"].get("description") or "").strip()
+    if description:
+        query += "\n\n" + description[:NEWS_DESCRIPTION_CHARS]
+    return query
+
+@cached("query")
+async def acall_perplexity(query, log=print):
     """
     Make a call to the perplexity API to obtain additional information.
 
@@ -242,6 +502,8 @@ def call_perplexity(query):
     query : str
         The query to pass to the perplexity API. This is the question we want to
         get information about.
+    log : Callable, optional
+        Where messages about retried requests go.
 
     Returns:
     --------
@@ -249,10 +511,9 @@ def call_perplexity(query):
         The response from the perplexity API.
     """
     url = "https://api.perplexity.ai/chat/completions"
-    api_key = config("PERPLEXITY_API_KEY", default="-")
     headers = {
         "accept": "application/json",
-        "authorization": f"Bearer {api_key}",
+        "authorization": f"Bearer {PERPLEXITY_API_KEY}",
         "content-type": "application/json",
     }
     payload = {
@@ -278,189 +539,212 @@ You do not produce forecasts yourself.
         ],
     }
 
-        # Use the retry mechanism for API requests
-    response = retry_request(requests.post, url, json=payload, headers=headers)
-    if response is not None:
-        content = response.json()["choices"][0]["message"]["content"]
-        return content
-    return None  # If retries failed, return None
+    # Use the retry mechanism for API requests
+    try:
+        response = await retry_request(CLIENT.post, url, content=orjson.dumps(payload), headers=headers, log=log)
+        return get_completion_content(response)
+    except (httpx.HTTPError, ValueError, KeyError):
+        return None  # If retries failed or the response is malformed, return None
 
-def summarize_rationales(rationales):
+async def summarize_rationales(rationales, log=print):
     
-    metac_token = config("METACULUS_TOKEN")
     # Build a prompt to summarize the rationales
-    summarization_prompt = (f"Summarize the following 5 rationales into a 4 to 6 bulletpoints (for all the 5 rationales combined) with the most noteworthy information repeated in most of the rationales: \n\n" + "\n\n".join(rationales))
+    summarization_prompt = (f"Summarize the following {len(rationales)} rationales into a 4 to 6 bulletpoints (for all the {len(rationales)} rationales combined) with the most noteworthy information repeated in most of the rationales: \n\n" + "\n\n".join(rationales))
                     
     # Call the LLM to generate the summary
-    summary_response = get_model("gpt-4o", metac_token)(summarization_prompt)
-    return summary_response   
+    summary_responses = await get_model("gpt-4o", METAC_TOKEN)(summarization_prompt, log=log)
+    return summary_responses[0]   
 
 def get_model(model_name: str, metac_token: str):
     """
-    Get the appropriate language model based on the provided model name.
-    This uses the classes provided by the llama-index library.
+    Get the language model to use based on the provided model name. Only
+    GPT-4o via the Metaculus proxy is supported.
 
     Parameters:
     -----------
     model_name :
-        The name of the model to instantiate. Supported values are:
-        "gpt-4o", "gpt-3.5-turbo", "anthropic", "o1-preview"
+        The name of the model to use. The only supported value is "gpt-4o".
+    metac_token :
+        The Metaculus token to authenticate with the proxy.
 
     Returns:
     --------
-    Union[OpenAI, Anthropic, None]
-        An instance of the specified model, or None if the model name is not recognized.
-
-    Note:
-    -----
-    This function relies on environment variables for API keys. These should be
-    stored in a file called ".env", which will be accessed using the
-    `config` function from the decouple library.
+    Callable
+        `acall_metaculus_proxy` with the token filled in.
     """
-    if model_name == "gpt-4o":
-        return lambda prompt: call_metaculus_proxy(prompt, metac_token)
-    else:
+    if model_name != "gpt-4o":
         raise ValueError("We want to use only 'gpt-4o' via Metaculus proxy.")
+    return functools.partial(acall_metaculus_proxy, metac_token=metac_token)
 
-    match model_name:
-        case "gpt-4o":
-            return OpenAI(
-                api_key=config("OPENAI_API_KEY", default=""),
-                model=model_name
-            )
-        case "gpt-3.5-turbo":
-            return OpenAI(
-                api_key=config("OPENAI_API_KEY", default=""),
-                model=model_name
-            )
-        case "anthropic":
-            tokenizer = Anthropic().tokenizer
-            Settings.tokenizer = tokenizer
-            return Anthropic(
-                api_key=config("ANTHROPIC_API_KEY", default=""),
-                model="claude-3-5-sonnet-20240620",
-            )
-        case "o1-preview":
-            return OpenAI(
-                api_key=config("OPENAI_API_KEY", default=""),
-                model=model_name
-            )
+class SequentialCallbacks:
+    """
+    Runs coroutines concurrently, but calls the callback attached to each of
+    them strictly in the order the coroutines were submitted. This keeps the
+    output of concurrently forecasted questions from interleaving.
+    """
 
-    return None
+    def __init__(self):
+        # set once the callbacks of all coroutines submitted so far have run
+        self.prev_event = asyncio.Event()
+        self.prev_event.set()
+        self.tasks = set()
+
+    async def run(self, coro, callback):
+        """
+        Await `coro` and return its result. Once it is done, successfully or
+        not, `callback()` is scheduled to run after the callbacks of all
+        coroutines submitted earlier. The caller does not wait for that.
+        """
+        prev_event, next_event = self.prev_event, asyncio.Event()
+        self.prev_event = next_event
+        try:
+            return await coro
+        finally:
+            task = asyncio.create_task(self._call_after(prev_event, next_event, callback))
+            # keep a reference, so the task isn't garbage collected while pending
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    @staticmethod
+    async def _call_after(prev_event, next_event, callback):
+        await prev_event.wait()
+        try:
+            callback()
+        finally:
+            next_event.set()
+
+    async def join(self):
+        """Wait until the callbacks of all submitted coroutines have run."""
+        await self.prev_event.wait()
 
-def main():
+async def main():
     """
     Main function to run the forecasting bot. This function accesses the questions
     for a given tournament, fetches information about them, and then uses an LLM
-    to generate a forecast.
+    to generate a forecast. Several questions are forecasted concurrently.
     """
     
     # Define bot parameters
     use_perplexity = True
     submit_predictions = True
     loading_processed_questions = True # Keep as False until ready for deployment - testing as True will result (with submit_prediction as True) in new questions being flagged as processed and not attempted to predict on.
-    metac_token = config("METACULUS_TOKEN")
     metac_base_url = "https://www.metaculus.com/api2"
     tournament_id = 32506
     llm_model_name = "gpt-4o"
+    today = datetime.date.today().isoformat()
     
-    all_questions = []
-    offset = 0
-
-    if loading_processed_questions:
-        processed_questions = load_processed_questions()
-
-    # Fetch all questions in batches (pagination mechanism)
-    while True:
-        questions = list_questions(metac_base_url, metac_token, tournament_id, offset=offset)
-        
-        # Debugging: Check how many questions are fetched and current offset
-        print(f"Fetched {len(questions)} questions with offset {offset}")
-
-        if len(questions) < 1:
-            print("No more questions to fetch, breaking loop.")
-            break
-
-        # Update the offset to fetch the next batch of questions
-        offset += len(questions)
-        all_questions.extend(questions)
-
-    # Process each question
-    for question in all_questions:
-        if question["id"] in processed_questions:
-            print(f"Skipping question ID {question['id']} (already processed)")
-            continue
-        print("Forecasting ", question["id"], question["question"]["title"])
+    # Always loaded, so that saving a new ID never drops previously processed ones
+    processed_questions = load_processed_questions()
 
-        # Get news summary from Perplexity if enabled
-        news_summary = call_perplexity(question["question"]["title"]) if use_perplexity else None
+    async def process_question(question, log):
+        """
+        Forecast a single question and post the prediction and comment. Output
+        is passed to `log` instead of being printed directly.
+        """
+        log(f"Forecasting {question['id']} {question['question']['title']}")
+
+        # Get news summary from Perplexity if enabled and useful. Results are
+        # cached for a day, so re-runs on the same day don't call it again.
+        news_summary = None
+        if use_perplexity and should_fetch_news(question):
+            news_summary = await acall_perplexity(build_news_query(question), log=log)
+        elif use_perplexity:
+            log(f"Skipping Perplexity for question {question['id']}")
 
         # Build prompt
-        prompt = build_prompt(
+        system_prompt, prompt = build_prompt(
             question["question"]["title"],
             question["question"]["description"],
             question["question"].get("resolution_criteria", ""),
             question["question"].get("fine_print", ""),
+            today,
             news_summary,
         )
 
-        print(f"\n\n*****\nPrompt for question {question['id']}/{question['question']['title']}:\n{prompt}\n\n")
+        log(f"\n\n*****\nPrompt for question {question['id']}/{question['question']['title']}:\n{prompt}\n\n")
 
         # Initialize variables to store predictions and rationale
         predictions = []
         rationales = []
 
         # Get the language model to be used based on the name
-        llm_model = get_model(llm_model_name, metac_token)
-
-        # Generate 5 predictions for each question
-        for i in range(5):
-            try:
-                response = llm_model(prompt)
-                llm_prediction = process_forecast_probability(response)
-                if llm_prediction is not None:
-                    predictions.append(llm_prediction)
-                    print(f"Prediction from run {i+1}: {llm_prediction}%")
-                rationales.append(f"Run {i+1}: {response}")
+        llm_model = get_model(llm_model_name, METAC_TOKEN)
 
-            except Exception as e:
-                print(f"Error generating prediction {i+1}: {e}")
-                continue
+        # Generate N_SAMPLES predictions for each question in a single request
+        try:
+            responses = await llm_model(
+                prompt,
+                system_prompt=system_prompt,
+                n=N_SAMPLES,
+                temperature=0 if N_SAMPLES == 1 else SAMPLING_TEMPERATURE,
+                json_output=True,
+                log=log,
+            )
+        except Exception as e:
+            log(f"Error generating predictions: {e}")
+            responses = []
+        for i, response in enumerate(responses):
+            llm_prediction, rationale = process_forecast(response)
+            if llm_prediction is not None:
+                predictions.append(llm_prediction)
+                log(f"Prediction from run {i+1}: {llm_prediction}%")
+            rationales.append(f"Run {i+1}: {rationale}" if N_SAMPLES > 1 else rationale)
 
         # Check if we have collected enough predictions
-        if len(predictions) < 5:
-            print(f"Only {len(predictions)} predictions collected for question {question['id']}. Skipping submission.")
-            continue
+        if len(predictions) < N_SAMPLES:
+            log(f"Only {len(predictions)} predictions collected for question {question['id']}. Skipping submission.")
+            return
 
-        # Calculate the average of the 5 predictions
-        average_prediction = sum(predictions) / len(predictions)
-        print(f"Average prediction for question {question['id']}: {average_prediction}%")
+        # Aggregate the predictions with the median, so a single outlier sample
+        # does not drag the forecast along
+        median_prediction = median(predictions)
+        log(f"Median prediction for question {question['id']}: {median_prediction}%")
 
-        # Ensure the average is a percentage (not a decimal)
-        formatted_average_prediction = float(average_prediction)  # Keep it as a percentage
+        # Ensure the median is a percentage (not a decimal)
+        formatted_median_prediction = float(median_prediction)  # Keep it as a percentage
 
         if submit_predictions:
             try:
-                # Post the average prediction
+                # Post the median prediction
                 post_url = f"{metac_base_url}/questions/{question['id']}/predict/"
-                response = requests.post(
+                response = await retry_request(
+                    CLIENT.post,
                     post_url,
-                    json={"prediction": formatted_average_prediction / 100},  # Submit as a decimal value
-                    headers={"Authorization": f"Token {metac_token}"},
+                    json={"prediction": formatted_median_prediction / 100},  # Submit as a decimal value
+                    headers={"Authorization": f"Token {METAC_TOKEN}"},
+                    log=log,
                 )
-                response.raise_for_status()
+            except Exception as e:
+                log(f"Error posting prediction: {e}")
+                return
 
-                if len(rationales) == 5:
-                # Summarize the rationales if more than one is collected
-                    consolidated_rationale = summarize_rationales(rationales)
+            log(f"Posted prediction for question {question['id']}")
 
-                if news_summary:
-                    consolidated_rationale += "\n\nUsed the following information from Perplexity:\n\n" + news_summary
+            # The prediction is in, so the question is not forecasted again even
+            # if posting the comment below fails
+            save_processed_question(question["id"], processed_questions)
 
-                print(f"This is the consolidated rationale: {consolidated_rationale}")
+            consolidated_rationale = ""
+            if len(rationales) == 1:
+                # There is nothing to consolidate, so no summary is requested
+                consolidated_rationale = rationales[0]
+            elif rationales:
+                try:
+                    # Summarize the rationales into a few bullet points
+                    consolidated_rationale = await summarize_rationales(rationales, log=log)
+                except Exception as e:
+                    log(f"Error summarizing rationales: {e}")
+                    consolidated_rationale = "\n\n".join(rationales[:2])
 
+            if news_summary:
+                consolidated_rationale += "\n\nUsed the following information from Perplexity:\n\n" + news_summary
+
+            log(f"This is the consolidated rationale: {consolidated_rationale}")
+
+            try:
                 comment_url = f"{metac_base_url}/comments/"
-                response = requests.post(
+                response = await retry_request(
+                    CLIENT.post,
                     comment_url,
                     json={
                         "comment_text": consolidated_rationale,
@@ -468,16 +752,74 @@ def main():
                         "include_latest_prediction": True,
                         "question": question["id"],
                     },
-                    headers={"Authorization": f"Token {metac_token}"},
+                    headers={"Authorization": f"Token {METAC_TOKEN}"},
+                    log=log,
                 )
-                response.raise_for_status()
+            except Exception as e:
+                log(f"Error posting comment: {e}")
+                return
 
-                print(f"Posted prediction and comment for question {question['id']} \n\n")
+            log(f"Posted comment for question {question['id']} \n\n")
 
-                save_processed_question(question["id"])
+    async def forecast(question, log):
+        """Forecast a question, logging unexpected errors instead of raising them."""
+        try:
+            await process_question(question, log)
+        except Exception as e:
+            log(f"Error forecasting question {question['id']}: {e}")
+
+    async def worker(queue):
+        """Forecast questions from the queue until a None is received."""
+        while (question := await queue.get()) is not None:
+            # The output of each question is collected and printed in one go, in
+            # the order the questions were taken from the queue
+            output = []
+            await sequential_callbacks.run(
+                forecast(question, output.append),
+                lambda output=output: print("\n".join(output)),
+            )
 
-            except Exception as e:
-                print(f"Error posting prediction or comment: {e}")
+    async def fetch_questions(queue):
+        """
+        Put every question that still needs a forecast on the queue, followed by
+        a None for each worker.
+        """
+        # Pages are offsets into a list ordered by activity, so a question that
+        # gets active while paging can show up on two pages
+        seen_ids = set()
+        try:
+            async for question in iter_questions(metac_base_url, METAC_TOKEN, tournament_id):
+                if question["id"] in seen_ids:
+                    continue
+                seen_ids.add(question["id"])
+                if loading_processed_questions and question["id"] in processed_questions:
+                    print(f"Skipping question ID {question['id']} (already processed)")
+                    continue
+                queue.put_nowait(question)
+        except Exception as e:
+            print(f"Error fetching questions: {e}. Finishing the questions fetched so far.")
+            raise
+        finally:
+            for _ in range(MAX_CONCURRENT_QUESTIONS):
+                queue.put_nowait(None)
+
+    # Questions are forecasted by MAX_CONCURRENT_QUESTIONS workers while further
+    # pages are still being fetched. The queue is unbounded, so fetching all
+    # pages takes seconds and the activity order has little time to change
+    # under the paging offsets.
+    queue = asyncio.Queue()
+    sequential_callbacks = SequentialCallbacks()
+    fetcher = asyncio.create_task(fetch_questions(queue))
+    workers = [asyncio.create_task(worker(queue)) for _ in range(MAX_CONCURRENT_QUESTIONS)]
+    try:
+        # The workers are stopped by the fetcher even if listing fails, so the
+        # questions fetched before a failure are still forecasted and posted
+        await asyncio.gather(*workers)
+        await sequential_callbacks.join()
+        # Re-raises a listing failure, so the run still ends with an error
+        await fetcher
+    finally:
+        await CLIENT.aclose()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())